@@ -1,10 +1,84 @@
-import psycopg2
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
 
+import asyncpg
+from fastapi import Request
+from psycopg2.pool import ThreadedConnectionPool
+
+PG_CONFIG = dict(
+    dbname="Kirox-System",
+    user="postgres",
+    password="123456",
+    host="localhost",
+    port="5432"
+)
+
+# === psycopg2 連線池（routers/auth.py 等同步路由使用） ===
+# 只服務流量很低的 auth 路由，開小一點；和下面的 asyncpg 池加總要遠低於 PostgreSQL max_connections
+# psycopg2 歸還時只保留 minconn 條閒置連線、多的直接關掉，所以 min 設成和 max 一樣，借出的連線都留著重用
+SYNC_POOL_MIN_SIZE = 10
+SYNC_POOL_MAX_SIZE = 10
+
+_sync_pool: ThreadedConnectionPool | None = None
+_sync_pool_lock = Lock()
+# ThreadedConnectionPool 借滿時 getconn() 直接拋 PoolError，不會等；
+# 同步路由跑在 anyio threadpool（預設 40 條），用 semaphore 讓多出來的 request 排隊等連線
+_sync_pool_slots = BoundedSemaphore(SYNC_POOL_MAX_SIZE)
+
+def _get_sync_pool() -> ThreadedConnectionPool:
+    # 第一次用到才建立：import db 不需要資料庫在線
+    global _sync_pool
+    if _sync_pool is None:
+        with _sync_pool_lock:
+            if _sync_pool is None:
+                _sync_pool = ThreadedConnectionPool(SYNC_POOL_MIN_SIZE, SYNC_POOL_MAX_SIZE, **PG_CONFIG)
+    return _sync_pool
+
+def close_sync_pool():
+    """service.py 的 lifespan 結束時呼叫，關閉所有 psycopg2 連線"""
+    global _sync_pool
+    with _sync_pool_lock:
+        if _sync_pool is not None:
+            _sync_pool.closeall()
+            _sync_pool = None
+
+@contextmanager
 def get_connection():
-    return psycopg2.connect(
-        dbname="Kirox-System",
-        user="postgres",
-        password="123456",
-        host="localhost",
-        port="5432"
+    """借一條 psycopg2 連線，離開 with 時歸還（出錯先 rollback，避免把壞交易還回池子）"""
+    pool = _get_sync_pool()
+    with _sync_pool_slots:
+        conn = pool.getconn()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn)
+
+# === asyncpg 連線池（routers/data.py 使用；在 service.py 的 lifespan 建立） ===
+PG_POOL_MIN_SIZE = 10
+PG_POOL_MAX_SIZE = 50
+PG_STATEMENT_CACHE_SIZE = 256   # 每條連線快取幾條 prepared statement（依 SQL 文字）
+
+async def _init_connection(conn: asyncpg.Connection):
+    # uuid 欄位以字串進出，和 psycopg2 的行為一致（response model 都是 str）
+    await conn.set_type_codec("uuid", encoder=str, decoder=str, schema="pg_catalog", format="text")
+
+async def create_pool() -> asyncpg.Pool:
+    return await asyncpg.create_pool(
+        database=PG_CONFIG["dbname"],
+        user=PG_CONFIG["user"],
+        password=PG_CONFIG["password"],
+        host=PG_CONFIG["host"],
+        port=int(PG_CONFIG["port"]),
+        min_size=PG_POOL_MIN_SIZE,
+        max_size=PG_POOL_MAX_SIZE,
+        statement_cache_size=PG_STATEMENT_CACHE_SIZE,
+        init=_init_connection,
     )
+
+async def get_conn(request: Request):
+    """FastAPI dependency：從 app.state.pg 借一條連線，request 結束自動歸還"""
+    async with request.app.state.pg.acquire() as conn:
+        yield conn
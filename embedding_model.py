@@ -1,60 +1,155 @@
 ### embedding_model.py
 
+import asyncio
 import logging
 import time
+from collections import OrderedDict
 from queue import Empty, Queue
-from threading import Event, Thread
+from threading import Lock, Thread
 
+import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
 
 logger = logging.getLogger(__name__)
 
-model = SentenceTransformer("BAAI/bge-small-zh-v1.5", device="cuda")
+MODEL_NAME = "BAAI/bge-small-zh-v1.5"
+# "onnx"：ONNX Runtime（需 pip install "sentence-transformers[onnx-gpu]"）
+# "torch"：原本的 PyTorch 後端（fp16）
+EMBEDDING_BACKEND = "onnx"
+
+# 每張 GPU 開幾個 worker（各自一份模型）；單卡上開 2 可讓 tokenize 與 GPU 計算重疊
+WORKERS_PER_DEVICE = 1
+
+def _load_model(device_index: int = 0) -> SentenceTransformer:
+    device = f"cuda:{device_index}"
+    if EMBEDDING_BACKEND == "onnx":
+        try:
+            return SentenceTransformer(
+                MODEL_NAME,
+                device=device,
+                backend="onnx",
+                model_kwargs={
+                    "provider": "CUDAExecutionProvider",
+                    "provider_options": {"device_id": device_index},
+                },
+            )
+        except Exception:
+            # 舊版 sentence-transformers 或沒裝 onnxruntime-gpu 時退回 PyTorch
+            logger.exception("ONNX backend 載入失敗，改用 PyTorch fp16")
+    m = SentenceTransformer(MODEL_NAME, device=device)
+    m.half()  # fp16 推論：encoder 記憶體頻寬減半，bge-small 檢索品質幾乎不受影響
+    return m
+
+# 每張可見 GPU（CUDA_VISIBLE_DEVICES）各載入模型，共用同一個 embedding_queue
+NUM_DEVICES = max(1, torch.cuda.device_count())
+models = [_load_model(i) for i in range(NUM_DEVICES) for _ in range(WORKERS_PER_DEVICE)]
 embedding_queue = Queue()
 
+MAX_BATCH = 64      # 單次 encode 最多幾筆（避免無上限 batch 撐爆 GPU）
+MAX_WAIT = 0.005    # 收到第一筆後，最多再等多久湊 batch（秒）
+
+CACHE_SIZE = 4096       # 查詢向量 LRU 容量
+CACHE_MAX_CHARS = 512   # 只快取短文本（查詢字串），長文本幾乎不會重複
+_cache: "OrderedDict[str, list]" = OrderedDict()
+_cache_lock = Lock()
+
 class EmbeddingTask:
-    def __init__(self, text, done: Event, timeout=10):
+    def __init__(self, text, loop: asyncio.AbstractEventLoop, timeout=10):
         self.text = text
-        self.done = done
-        self.result = None
         self.timeout = timeout
+        # 呼叫端（aget_embedding）await 這個 Future，由 worker thread 透過 loop 喚醒
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def set_result(self, result):
+        """worker thread 呼叫：把結果交回 event loop"""
+        self.loop.call_soon_threadsafe(self._resolve_future, result)
 
-    def wait(self):
-        start = time.time()
-        while not self.done.is_set():
-            if time.time() - start > self.timeout:
-                logger.warning("Embedding wait 超時，回傳空向量")
-                return [0.0] * 512
-            time.sleep(0.01)
-        return self.result
+    def _resolve_future(self, result):
+        # 呼叫端可能已超時取消
+        if not self.future.done():
+            self.future.set_result(result)
 
-def embedding_worker():
+def embedding_worker(model: SentenceTransformer):
     while True:
         tasks = []
         try:
             task = embedding_queue.get()
             tasks.append(task)
-            time.sleep(0.01)  # 累積更多 batch
-            while not embedding_queue.empty():
-                tasks.append(embedding_queue.get())
+            # 只在有東西可拿時短暫等待累積 batch，湊滿 MAX_BATCH 就立刻送
+            # MAX_WAIT 是整個 batch 的總預算（從第一筆起算），不是每筆各等一次，
+            # 否則請求以 <MAX_WAIT 的間隔陸續進來時，第一筆會被一直拖住
+            deadline = time.monotonic() + MAX_WAIT
+            while len(tasks) < MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    tasks.append(embedding_queue.get(timeout=remaining))
+                except Empty:
+                    break
             texts = [t.text for t in tasks]
-            vectors = model.encode(texts)
+            vectors = model.encode(
+                texts,
+                batch_size=MAX_BATCH,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+            # fp16 輸出在邊界一次轉回 float32（Milvus FLOAT_VECTOR）
+            vectors = vectors.astype(np.float32, copy=False)
             for task, vec in zip(tasks, vectors):
-                task.result = vec.tolist()
-                task.done.set()
+                task.set_result(vec.tolist())
         except Exception as e:
             logger.exception("Embedding Worker 錯誤")
             for task in tasks:
-                task.result = [0.0] * 512
-                task.done.set()
+                task.set_result([0.0] * 512)
 
-Thread(target=embedding_worker, daemon=True).start()
+for i, m in enumerate(models):
+    Thread(target=embedding_worker, args=(m,), daemon=True, name=f"embedding-worker-{i}").start()
+logger.info("Embedding workers: %s（%s 張 GPU）", len(models), NUM_DEVICES)
 
-def get_embedding(text: str) -> list:
-    done = Event()
-    task = EmbeddingTask(text, done)
-    embedding_queue.put(task)
-    vec = task.wait()
+def _cache_get(key: str):
+    with _cache_lock:
+        vec = _cache.get(key)
+        if vec is not None:
+            _cache.move_to_end(key)
+        return vec
+
+def _cache_put(key: str, vec: list):
+    with _cache_lock:
+        _cache[key] = vec
+        _cache.move_to_end(key)
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def _cache_key(text: str):
+    return text.strip() if isinstance(text, str) and len(text) <= CACHE_MAX_CHARS else None
+
+def _finish(key, vec: list) -> list:
     logger.info("Embedding shape: %s", len(vec))
+    # 超時/錯誤回傳的是全 0 向量，不能進快取
+    if key is not None and len(vec) == 512 and any(vec):
+        _cache_put(key, vec)
     assert len(vec) == 512, f"Embedding 維度錯誤！現在長度: {len(vec)}，預期 512"
     return vec
+
+async def aget_embedding(text: str) -> list:
+    """
+    取得 text 的 embedding：交給背景 worker 合併成 batch encode，等待時不佔用 threadpool，也不阻塞 event loop。
+    """
+    key = _cache_key(text)
+    if key is not None:
+        vec = _cache_get(key)
+        if vec is not None:
+            return vec
+
+    task = EmbeddingTask(text, asyncio.get_running_loop())
+    embedding_queue.put(task)
+    try:
+        vec = await asyncio.wait_for(task.future, task.timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Embedding wait 超時，回傳空向量")
+        vec = [0.0] * 512
+    return _finish(key, vec)
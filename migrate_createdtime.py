@@ -0,0 +1,63 @@
+# 一次性遷移：把舊版 createdtime (VARCHAR, ISO8601) 轉成 INT64 epoch 毫秒
+# 流程：舊 collection 改名為 <name>_iso_backup → 由 milvus_helper 依新 schema 重建 → 逐批搬資料
+# 確認新資料無誤後，再手動 drop *_iso_backup
+from datetime import datetime, timezone
+
+from pymilvus import Collection, connections, list_collections, utility
+
+MILVUS_HOST = "127.0.0.1"
+MILVUS_PORT = "19530"
+
+# name -> insert 欄位順序（需與 milvus_helper.py schema 一致）
+COLLECTION_FIELDS = {
+    "chat_memory": ["chatid", "robotid", "embedding", "text", "user_msg", "tool_msg",
+                    "ai_msg", "image_base64", "createdtime"],
+    "kb_memory":   ["docid", "robotid", "embedding", "text", "title", "source", "createdtime"],
+}
+BATCH = 1000
+
+
+def _iso_to_ms(ts) -> int:
+    try:
+        dt = datetime.fromisoformat(ts)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return int(dt.timestamp() * 1000)
+    except Exception:
+        return 0
+
+
+connections.connect(alias="default", host=MILVUS_HOST, port=MILVUS_PORT)
+existing = list_collections()
+for name in COLLECTION_FIELDS:
+    if name in existing:
+        utility.rename_collection(name, f"{name}_iso_backup")
+        print(f"{name} -> {name}_iso_backup")
+
+# import 時會依新 schema 建立 collection
+import milvus_helper  # noqa: E402
+
+targets = {"chat_memory": milvus_helper.collection, "kb_memory": milvus_helper.kb_collection}
+for name, fields in COLLECTION_FIELDS.items():
+    backup = f"{name}_iso_backup"
+    if backup not in list_collections():
+        continue
+    old = Collection(backup)
+    old.load()
+    it = old.query_iterator(batch_size=BATCH, expr=f"{fields[0]} >= 0", output_fields=fields)
+    moved = 0
+    while True:
+        rows = it.next()
+        if not rows:
+            it.close()
+            break
+        # 新 collection 在 import milvus_helper 時已插入自己的 dummy，舊 dummy 不搬，避免主鍵重複
+        rows = [r for r in rows if r[fields[0]] != milvus_helper.DUMMY_PK]
+        if not rows:
+            continue
+        for r in rows:
+            r["createdtime"] = _iso_to_ms(r.get("createdtime"))
+        targets[name].insert([[r[f] for r in rows] for f in fields])
+        moved += len(rows)
+    targets[name].flush()
+    print(f"{name}: 已搬移 {moved} 筆")
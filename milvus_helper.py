@@ -1,53 +1,244 @@
+import asyncio
 import logging
 import time
 from datetime import datetime, timezone
-from threading import Thread
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
 
 from pymilvus import (
+    AsyncMilvusClient,
     Collection,
     CollectionSchema,
     DataType,
     FieldSchema,
     connections,
-    list_collections,
+    utility,
 )
 logger = logging.getLogger(__name__)
 
 # === 基本連線設定（需要就自行調整） ===
 MILVUS_HOST = "127.0.0.1"
 MILVUS_PORT = "19530"
+MILVUS_URI  = f"http://{MILVUS_HOST}:{MILVUS_PORT}"
 
 # === Collection 名稱與向量維度 ===
 CHAT_COLLECTION_NAME = "chat_memory"
 KB_COLLECTION_NAME   = "kb_memory"
 
 VECTOR_DIM = 512      # 兩個 collection 共用同維度（要改就一起改）
+DUMMY_PK = 99999999   # 空庫建索引用的 dummy 資料主鍵
+
+# kb_memory VARCHAR 欄位上限（Milvus 以 UTF-8 bytes 計）；建表與寫入前檢查共用
+KB_MAX_LENGTHS = {"robotid": 36, "text": 16384, "title": 512, "source": 1024}
+
+# === 向量索引與搜尋參數（改 metric_type 時兩邊要一致） ===
+# embedding_model 輸出已 L2 normalize，IP 等同 cosine
+# 量化索引：原始 fp32 向量（512 維 2KB/筆）不再整份載入記憶體
+#   chat：寫入頻繁、召回要求中等 → IVF_SQ8（int8 標量量化，約 1/4 記憶體）
+#   kb  ：讀多寫少、語料較大     → IVF_PQ（m=16, nbits=8，每筆 16 bytes）
+# 不改用 FLOAT16_VECTOR 欄位：索引已量化到 int8 / PQ，搜尋掃的是量化後的 code；
+# 改欄位型別需重建 collection 並搬資料，只省下磁碟上的原始向量
+CHAT_INDEX_PARAMS = {
+    "index_type": "IVF_SQ8",
+    "metric_type": "IP",
+    "params": {"nlist": 256},
+}
+KB_INDEX_PARAMS = {
+    "index_type": "IVF_PQ",
+    "metric_type": "IP",
+    "params": {"nlist": 1024, "m": 16, "nbits": 8},
+}
+CHAT_SEARCH_PARAMS = {"metric_type": "IP", "params": {"nprobe": 16}}
+KB_SEARCH_PARAMS   = {"metric_type": "IP", "params": {"nprobe": 32}}
 
 # === 對外暴露（保持舊相容性：collection = 聊天用） ===
 collection = None       # chat collection（與你原本的 import 相容）
 kb_collection = None    # knowledge base collection
 
-def _now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat()
+FLUSH_INTERVAL = 30     # 有寫入後，最多隔多久 flush 一次（秒）
+
+# 每個 collection 一條背景 flush thread；重複呼叫 ensure_collections() 不會再開
+_flush_threads: dict = {}
+_collections: dict = {}   # name -> 最新的 Collection 物件
+_dirty: dict = {}           # name -> Event，set 表示有尚未 flush 的 insert/delete
+
+# hot path（search / query）用的 async client：grpc.aio 讓多個 RPC 在同一條 HTTP/2 連線上並行，
+# 不會像同步 client 那樣在 threadpool 裡互相排隊。DDL（ensure_collection）仍走同步 Collection。
+_async_client = None
+_async_client_loop = None
+
+def get_async_client() -> AsyncMilvusClient:
+    """
+    取得綁定在目前 event loop 的 AsyncMilvusClient（第一次呼叫時建立，之後沿用）。
+    grpc.aio channel 綁定建立它的 loop，換 loop（例如測試重開 loop）時會重建。
+    """
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = AsyncMilvusClient(uri=MILVUS_URI)
+        _async_client_loop = loop
+        logger.info("[Milvus] AsyncMilvusClient 已連線：%s", MILVUS_URI)
+    return _async_client
+
+def mark_dirty(name: str):
+    """insert/delete 之後呼叫，讓背景 thread 在下個週期 flush（沒寫入就不打 Milvus）"""
+    _dirty.setdefault(name, Event()).set()
+
+# === 批次 insert：把多個 request 的單筆寫入合併成一次 insert RPC ===
+class _InsertTask:
+    def __init__(self, row: list, loop: asyncio.AbstractEventLoop):
+        self.row = row
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def finish(self, error=None):
+        """worker thread 呼叫：把結果（或例外）交回 event loop"""
+        self.loop.call_soon_threadsafe(self._resolve_future, error)
+
+    def _resolve_future(self, error):
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(None)
+
+
+class InsertBatcher:
+    """
+    背景 thread 收集單筆 row，湊滿 max_rows 或等滿 max_wait 秒就轉成欄位 list 一次 insert。
+    row 的欄位順序需與 collection schema 完全一致。
+    """
+
+    def __init__(self, name: str, max_rows: int = 128, max_wait: float = 0.02):
+        self.name = name
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        self.queue = Queue()
+        Thread(target=self._worker, daemon=True, name=f"milvus-insert-{name}").start()
+
+    async def ainsert(self, row: list, timeout: float = 10):
+        """await 到這筆 row 已寫入 Milvus（失敗時拋出原本的例外）；等待時不佔用 threadpool"""
+        task = _InsertTask(row, asyncio.get_running_loop())
+        self.queue.put(task)
+        try:
+            await asyncio.wait_for(task.future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"{self.name} insert 超時")
+
+    def _worker(self):
+        while True:
+            tasks = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(tasks) < self.max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    tasks.append(self.queue.get(timeout=remaining))
+                except Empty:
+                    break
+            try:
+                self._insert(tasks)
+            except Exception as e:
+                if len(tasks) == 1:
+                    logger.exception("[Milvus Insert] %s 寫入失敗", self.name)
+                    tasks[0].finish(e)
+                else:
+                    # 整批 insert 是全有全無：可能只是其中一筆不合法（例如欄位超長），
+                    # 逐筆重試，只讓壞掉的那筆失敗，不拖累同批其他 request
+                    logger.warning("[Milvus Insert] %s 批次寫入失敗（%s 筆），改逐筆重試", self.name, len(tasks))
+                    self._insert_each(tasks)
+                continue
+            for t in tasks:
+                t.finish()
+
+    def _insert_each(self, tasks: list):
+        for t in tasks:
+            try:
+                self._insert([t])
+            except Exception as e:
+                logger.exception("[Milvus Insert] %s 單筆寫入失敗", self.name)
+                t.finish(e)
+            else:
+                t.finish()
+
+    def _insert(self, tasks: list):
+        # rows → columns（Milvus insert 吃欄位導向的 list）
+        columns = [list(c) for c in zip(*(t.row for t in tasks))]
+        _collections[self.name].insert(columns)
+        mark_dirty(self.name)
+
+
+# === createdtime 時間工具（routers/chat.py、routers/kb.py 共用） ===
+def _now_ms() -> int:
+    # createdtime 一律存 UTC epoch 毫秒（INT64），可建 scalar index 做整數比較
+    # epoch 毫秒本來就是 UTC，直接取 time_ns，不必經過 datetime / tzinfo
+    return time.time_ns() // 1_000_000
+
+# chatid / docid（INT64 PK）用的遞增序號：以毫秒時間戳為基準，同一毫秒內的第二筆起 +1，
+# 避免 async handler 在同一個 event loop tick 內拿到相同的 PK（batcher 會把它們寫進同一批）
+_last_id = 0
+_last_id_lock = Lock()
+
+def _next_id() -> int:
+    global _last_id
+    with _last_id_lock:
+        _last_id = max(_now_ms(), _last_id + 1)
+        return _last_id
+
+def _ms_to_dt_utc(ms: int) -> datetime:
+    """
+    把 createdtime (UTC epoch 毫秒) 轉成 datetime(aware, UTC)
+    若壞資料就丟掉那筆
+    """
+    try:
+        return datetime.fromtimestamp(int(ms) / 1000, tz=timezone.utc)
+    except Exception:
+        return None
+
+def _ms_to_iso(ms) -> str:
+    """
+    createdtime 在 Milvus 內是 epoch 毫秒，對外仍回 ISO8601 (UTC) 字串
+    """
+    dt = _ms_to_dt_utc(ms) if ms is not None else None
+    return dt.isoformat() if dt else None
+
+def _check_createdtime_type(col: Collection):
+    """
+    舊版 createdtime 是 VARCHAR (ISO8601)；沿用舊 collection 會在建 STL_SORT 索引 / INT64 insert 時失敗，
+    這裡先擋下並提示執行遷移腳本。
+    """
+    for f in col.schema.fields:
+        if f.name == "createdtime" and f.dtype != DataType.INT64:
+            raise RuntimeError(
+                f"[Milvus] {col.name}.createdtime 仍是舊版 {f.dtype.name}，需為 INT64 (epoch 毫秒)；"
+                "請先停止服務並執行 `python migrate_createdtime.py` 遷移資料"
+            )
 
 def _ensure_collection(
     name: str,
     vector_dim: int,
     extra_fields: list,
     pk_name: str,
+    index_params: dict,
     need_dummy: bool = True
 ) -> Collection:
     """
-    建立或載入指定名稱的 Collection，若空庫則插入一筆 dummy，並建立 IVF_FLAT + L2 索引與載入。
+    建立或載入指定名稱的 Collection，若空庫則插入一筆 dummy，並依 index_params 建立向量索引與載入。
+    既有索引的 index_type / metric_type 與 index_params 不同時會重建。
     extra_fields: 需包含 robotid / embedding / text / ... 等欄位（除了主鍵）。
     """
-    # 1) 連線
-    connections.connect(alias="default", host=MILVUS_HOST, port=MILVUS_PORT)
+    # 1) 連線（已連過就沿用）
+    if not connections.has_connection("default"):
+        connections.connect(alias="default", host=MILVUS_HOST, port=MILVUS_PORT)
 
-    # 2) 建立/載入
-    if name in list_collections():
+    # 2) 建立/載入（這個 process 已確保過就直接沿用，否則只查單一名稱，不列出全部 collection）
+    col = _collections.get(name)
+    if col is None and utility.has_collection(name):
         col = Collection(name)
-    else:
+        _check_createdtime_type(col)
+    elif col is None:
         fields = [FieldSchema(name=pk_name, dtype=DataType.INT64, is_primary=True, auto_id=False)]
         fields.extend(extra_fields)
         schema = CollectionSchema(fields, description=f"{name} collection")
@@ -60,7 +251,7 @@ def _ensure_collection(
         # 依不同 collection 的欄位順序插入
         if name == CHAT_COLLECTION_NAME:
             col.insert([
-                [99999999],          # chatid
+                [DUMMY_PK],          # chatid
                 ["dummy"],           # robotid
                 [dummy_vec],         # embedding
                 ["dummy for index"], # text
@@ -68,46 +259,70 @@ def _ensure_collection(
                 [""],                # tool_msg
                 [""],                # ai_msg
                 [""],                # image_base64
-                [_now_iso()],        # createdtime
+                [_now_ms()],         # createdtime
             ])
         else:
             # kb_memory 欄位順序（見下方 extra_fields 定義）
             col.insert([
-                [99999999],          # docid
+                [DUMMY_PK],          # docid
                 ["dummy"],           # robotid
                 [dummy_vec],         # embedding
                 ["dummy for index"], # text（全文/摘要/切片）
                 [""],                # title
                 [""],                # source （檔名/URL/路徑）
-                [_now_iso()],        # createdtime
+                [_now_ms()],         # createdtime
             ])
         col.flush()
         logger.info("[Milvus] [%s] 已插入 Dummy 資料供建立索引", name)
 
     # 4) 建索引（如未建立）
     # 注意：如果你改 metric_type，search 時也要一致
-    if not col.has_index():
-        index_params = {
-            "index_type": "IVF_FLAT",
-            "metric_type": "L2",
-            "params": {"nlist": 128}
-        }
-        col.create_index(field_name="embedding", index_params=index_params)
+    indexes = {idx.field_name: idx for idx in col.indexes}
+    indexed_fields = set(indexes)
+    old = indexes.get("embedding")
+    if old is not None and (
+        old.params.get("index_type") != index_params["index_type"]
+        or old.params.get("metric_type") != index_params["metric_type"]
+    ):
+        # 索引設定變更（例如 IVF_FLAT/L2 → HNSW/IP）：先 release 才能 drop 舊索引
+        col.release()
+        col.drop_index(index_name=old.index_name)
+        indexed_fields.discard("embedding")
+        logger.info("[Milvus] [%s] 舊 embedding index 已移除（%s）", name, old.params)
+    if "embedding" not in indexed_fields:
+        col.create_index(field_name="embedding", index_params=index_params, index_name="embedding_idx")
         logger.info("[Milvus] [%s] embedding index 建立完成！", name)
 
+    # createdtime (INT64) 建排序索引，時間範圍篩選不必逐筆比較
+    if "createdtime" not in indexed_fields:
+        col.create_index(
+            field_name="createdtime",
+            index_params={"index_type": "STL_SORT"},
+            index_name="createdtime_idx",
+        )
+        logger.info("[Milvus] [%s] createdtime index 建立完成！", name)
+
     # 5) 載入到記憶體
     col.load()
 
-    # 6) 背景 flush
+    # 6) 背景 flush（只在有寫入時才 flush）
+    _collections[name] = col
+    dirty = _dirty.setdefault(name, Event())
+
     def background_flush():
         while True:
             try:
-                time.sleep(30)
-                col.flush()
+                dirty.wait()                # 閒置時直接阻塞，不打任何 RPC
+                time.sleep(FLUSH_INTERVAL)  # 累積一段時間的寫入再一起 flush
+                dirty.clear()
+                _collections[name].flush()
             except Exception as e:
                 logger.exception("[Milvus Flush] %s 錯誤", name)
 
-    Thread(target=background_flush, daemon=True).start()
+    if name not in _flush_threads:
+        t = Thread(target=background_flush, daemon=True, name=f"milvus-flush-{name}")
+        _flush_threads[name] = t
+        t.start()
 
     return col
 
@@ -123,33 +338,38 @@ def ensure_collections():
         FieldSchema(name="tool_msg",     dtype=DataType.VARCHAR, max_length=4096),
         FieldSchema(name="ai_msg",       dtype=DataType.VARCHAR, max_length=4096),
         FieldSchema(name="image_base64", dtype=DataType.VARCHAR, max_length=65535),
-        FieldSchema(name="createdtime",  dtype=DataType.VARCHAR, max_length=64),
+        FieldSchema(name="createdtime",  dtype=DataType.INT64),                   # UTC epoch 毫秒
     ]
     collection = _ensure_collection(
         name=CHAT_COLLECTION_NAME,
         vector_dim=VECTOR_DIM,
         extra_fields=chat_extra_fields,
         pk_name="chatid",
+        index_params=CHAT_INDEX_PARAMS,
         need_dummy=True
     )
 
     # --- 知識庫用 collection（新增） ---
     # 簡潔設計：docid / robotid / embedding / text / title / source / createdtime
     kb_extra_fields = [
-        FieldSchema(name="robotid",     dtype=DataType.VARCHAR, max_length=36),
+        FieldSchema(name="robotid",     dtype=DataType.VARCHAR, max_length=KB_MAX_LENGTHS["robotid"]),
         FieldSchema(name="embedding",   dtype=DataType.FLOAT_VECTOR, dim=VECTOR_DIM),
-        FieldSchema(name="text",        dtype=DataType.VARCHAR, max_length=16384),  # 知識內容（可放 chunk）
-        FieldSchema(name="title",       dtype=DataType.VARCHAR, max_length=512),    # 標題（可選）
-        FieldSchema(name="source",      dtype=DataType.VARCHAR, max_length=1024),   # 來源（檔名/URL/路徑）
-        FieldSchema(name="createdtime", dtype=DataType.VARCHAR, max_length=64),
+        FieldSchema(name="text",        dtype=DataType.VARCHAR, max_length=KB_MAX_LENGTHS["text"]),    # 知識內容（可放 chunk）
+        FieldSchema(name="title",       dtype=DataType.VARCHAR, max_length=KB_MAX_LENGTHS["title"]),   # 標題（可選）
+        FieldSchema(name="source",      dtype=DataType.VARCHAR, max_length=KB_MAX_LENGTHS["source"]),  # 來源（檔名/URL/路徑）
+        FieldSchema(name="createdtime", dtype=DataType.INT64),                    # UTC epoch 毫秒
     ]
     kb_collection = _ensure_collection(
         name=KB_COLLECTION_NAME,
         vector_dim=VECTOR_DIM,
         extra_fields=kb_extra_fields,
         pk_name="docid",
+        index_params=KB_INDEX_PARAMS,
         need_dummy=True
     )
 
 # 模組載入即確保兩個 collection 可用
 ensure_collections()
+
+chat_insert_batcher = InsertBatcher(CHAT_COLLECTION_NAME)
+kb_insert_batcher = InsertBatcher(KB_COLLECTION_NAME)
@@ -82,7 +82,7 @@ class ChatMessage(BaseModel):
     tool_msg: Optional[str] = None
     ai_msg: Optional[str] = None
     image_base64: Optional[str] = None
-    createdtime: Optional[str] = None  # 用字串方便外部（如 Milvus）處理
+    createdtime: Optional[str] = None  # ISO8601 (UTC) 字串；Milvus 內部存 epoch 毫秒
 
 class AddChatRequest(BaseModel):
     robotid: str
@@ -98,6 +98,7 @@ class AddChatResponse(BaseModel):
 class GetChatHistoryRequest(BaseModel):
     robotid: str
     limit: Optional[int] = 20
+    include_images: bool = False  # True 才回傳 image_base64（單筆最大 64KB）
 
 class GetChatHistoryResponse(BaseModel):
     message: str
@@ -107,6 +108,7 @@ class SearchChatRequest(BaseModel):
     robotid: str
     query_text: str
     limit: int = 5
+    include_images: bool = False  # True 才回傳 image_base64（單筆最大 64KB）
 
 
 # === 知識庫 ===
@@ -126,7 +128,7 @@ class KnowledgeChunk(BaseModel):
     text: str
     title: Optional[str] = None
     source: Optional[str] = None
-    createdtime: Optional[str] = None  # ISO8601 字串
+    createdtime: Optional[str] = None  # ISO8601 (UTC) 字串；Milvus 內部存 epoch 毫秒
 
 class SearchKnowledgeRequest(BaseModel):
     robotid: str
@@ -9,12 +9,9 @@ router = APIRouter()
 
 @router.post("/login", response_model=LoginResponse)
 def login(data: LoginRequest):
-    conn = get_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT password, status, userid FROM useraccount WHERE gmail = %s", (data.gmail,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("SELECT password, status, userid FROM useraccount WHERE gmail = %s", (data.gmail,))
+        user = cursor.fetchone()
 
     if not user:
         raise HTTPException(status_code=404, detail="帳號不存在")
@@ -27,42 +24,31 @@ def login(data: LoginRequest):
 
 @router.post("/change-password", response_model=BaseResponse)
 def change_password(data: ChangePasswordRequest):
-    conn = get_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT password FROM useraccount WHERE userid = %s", (data.userid,))
-    user = cursor.fetchone()
-    if not user:
-        cursor.close()
-        conn.close()
-        raise HTTPException(status_code=404, detail="找不到使用者")
-    if user["password"] != data.oldpassword:
-        cursor.close()
-        conn.close()
-        raise HTTPException(status_code=401, detail="舊密碼錯誤")
-
-    cursor.execute("UPDATE useraccount SET password = %s, updatetime = %s WHERE userid = %s",
-                   (data.newpassword, date.today(), data.userid))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    # 只讀單一欄位，用預設 tuple cursor 即可，不必每列建 dict
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT password FROM useraccount WHERE userid = %s", (data.userid,))
+        user = cursor.fetchone()
+        if not user:
+            raise HTTPException(status_code=404, detail="找不到使用者")
+        if user[0] != data.oldpassword:
+            raise HTTPException(status_code=401, detail="舊密碼錯誤")
+
+        cursor.execute("UPDATE useraccount SET password = %s, updatetime = %s WHERE userid = %s",
+                       (data.newpassword, date.today(), data.userid))
+        conn.commit()
     return BaseResponse(message="密碼已成功變更")
 
 @router.post("/register", response_model=BaseResponse)
 def register(data: RegisterRequest):
-    conn = get_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT gmail FROM useraccount WHERE gmail = %s", (data.gmail,))
-    if cursor.fetchone():
-        cursor.close()
-        conn.close()
-        raise HTTPException(status_code=409, detail="信箱已被註冊")
-
-    new_userid = str(uuid4())
-    cursor.execute("""
-        INSERT INTO useraccount (userid, gmail, password, nickname, status, updatetime)
-        VALUES (%s, %s, %s, %s, %s, %s)
-    """, (new_userid, data.gmail, data.password, data.nickname, True, date.today()))
-    conn.commit()
-    cursor.close()
-    conn.close()
-    return BaseResponse(message="註冊成功")
\ No newline at end of file
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM useraccount WHERE gmail = %s", (data.gmail,))
+        if cursor.fetchone():
+            raise HTTPException(status_code=409, detail="信箱已被註冊")
+
+        new_userid = str(uuid4())
+        cursor.execute("""
+            INSERT INTO useraccount (userid, gmail, password, nickname, status, updatetime)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (new_userid, data.gmail, data.password, data.nickname, True, date.today()))
+        conn.commit()
+    return BaseResponse(message="註冊成功")
@@ -1,23 +1,64 @@
 import asyncio
 import logging
 import time
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from fastapi import APIRouter, HTTPException, Query, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 
 # 建立 Router
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+class FrameSlot:
+    """
+    單一 (robot_id, camera_id) 最新一張影像。
+    cond：有新 frame 時 notify_all，讓 MJPEG viewer 直接被喚醒，不必輪詢。
+    refs：目前持有這個 slot 的上傳端 + MJPEG viewer 數，用來決定離開時能否把空 slot 收掉。
+    """
+    __slots__ = ("frame", "timestamp", "cond", "refs")
+
+    def __init__(self):
+        self.frame: Optional[bytes] = None
+        self.timestamp: float = 0.0
+        self.cond = asyncio.Condition()
+        self.refs: int = 0
+
+
 # 用來存每台機器人最新的一張影像
 # key: (robot_id, camera_id)
-# value: {"frame": bytes, "timestamp": float}
-frames: Dict[Tuple[str, str], Dict[str, Any]] = {}
+# value: FrameSlot
+frames: Dict[Tuple[str, str], FrameSlot] = {}
+
+
+def _get_slot(key: Tuple[str, str]) -> FrameSlot:
+    slot = frames.get(key)
+    if slot is None:
+        slot = frames[key] = FrameSlot()
+    return slot
+
+
+def _release_slot(key: Tuple[str, str], slot: FrameSlot):
+    """
+    上傳端 / viewer 離開時呼叫：若這個 slot 從沒收到 frame 且已沒人持有，就從 frames 移除，
+    避免任意 robot_id 的 GET /mjpeg 在 frames 裡留下永遠不會清掉的空 slot。
+    收過 frame 的 slot 照舊保留（snapshot / robots/online 要用）。
+    """
+    slot.refs -= 1
+    if slot.refs == 0 and slot.frame is None and frames.get(key) is slot:
+        del frames[key]
 
 # MJPEG 的 boundary 名稱
 MJPEG_BOUNDARY = "frame"
 
+# 每幀 multipart header 的固定部分，只差 Content-Length 數字
+MJPEG_PREFIX = (
+    f"--{MJPEG_BOUNDARY}\r\n"
+    "Content-Type: image/jpeg\r\n"
+    "Content-Length: "
+).encode("utf-8")
+MJPEG_SUFFIX = b"\r\n\r\n"
+
 
 @router.websocket("/upload/ws")
 async def camera_upload_ws(
@@ -34,6 +75,8 @@ async def camera_upload_ws(
     """
     await websocket.accept()
     key = (robot_id, camera_id)
+    slot = _get_slot(key)
+    slot.refs += 1  # 連上但還沒送第一張前，不讓 viewer 離開時把這個 slot 收掉
     logger.info("[WS UPLOAD] connected: robot_id=%s, camera_id=%s", robot_id, camera_id)
 
     try:
@@ -41,11 +84,11 @@ async def camera_upload_ws(
             # 等待 client 傳來一塊 binary（JPEG）
             data = await websocket.receive_bytes()
 
-            # 更新最新影像與時間戳
-            frames[key] = {
-                "frame": data,
-                "timestamp": time.time(),
-            }
+            # 更新最新影像與時間戳，並喚醒所有等待中的 viewer
+            async with slot.cond:
+                slot.frame = data
+                slot.timestamp = time.time()
+                slot.cond.notify_all()
 
     except WebSocketDisconnect as e:
         # 把 close code 印出來，方便你之後判斷是正常關還是被代理砍
@@ -60,6 +103,8 @@ async def camera_upload_ws(
         logger.exception(
             "[WS UPLOAD] error for robot_id=%s, camera_id=%s", robot_id, camera_id
         )
+    finally:
+        _release_slot(key, slot)
 
 
 async def mjpeg_generator(robot_id: str, camera_id: str = "default"):
@@ -68,12 +113,23 @@ async def mjpeg_generator(robot_id: str, camera_id: str = "default"):
 
     設計：
     - 只在「有新 frame」時才送，避免一直重送舊圖造成 App 閃爍
+    - 以 FrameSlot.cond 等待新 frame（上傳端 notify_all），不輪詢
     - 控制最大串流 FPS（max_stream_fps）
     - 永遠只拿 frames 裡「當下最新」的一張，不排隊、不堆 buffer
     - 若長時間沒有任何新 frame，可設定 timeout 中止串流
     """
     key = (robot_id, camera_id)
+    # 上傳端還沒連線時先建空 slot 掛著等；離開時由 _release_slot 收掉沒用到的空 slot
+    slot = _get_slot(key)
+    slot.refs += 1
+    try:
+        async for chunk in _mjpeg_frames(slot, robot_id, camera_id):
+            yield chunk
+    finally:
+        _release_slot(key, slot)
+
 
+async def _mjpeg_frames(slot: FrameSlot, robot_id: str, camera_id: str):
     # 最長多久沒有任何新 frame 就中止串流（秒；0 表示不超時）
     stream_timeout_seconds = 60
 
@@ -83,55 +139,33 @@ async def mjpeg_generator(robot_id: str, camera_id: str = "default"):
         max_stream_fps = 1.0
     min_interval = 1.0 / max_stream_fps
 
-    last_send_time: float = 0.0
     last_frame_ts: float = 0.0
-    last_valid_time: float = time.time()
+    wait_timeout = stream_timeout_seconds if stream_timeout_seconds > 0 else None
 
     while True:
-        now = time.time()
-
-        # timeout：太久沒有任何新 frame → 中止串流，交給 client 決定是否重連
-        if stream_timeout_seconds > 0 and now - last_valid_time > stream_timeout_seconds:
+        # 等到有「新」 frame（Jetson 還沒開始上傳或暫停中時就一直掛著）
+        try:
+            async with slot.cond:
+                await asyncio.wait_for(
+                    slot.cond.wait_for(lambda: slot.timestamp != last_frame_ts),
+                    timeout=wait_timeout,
+                )
+                frame: bytes = slot.frame
+                last_frame_ts = slot.timestamp
+        except asyncio.TimeoutError:
+            # timeout：太久沒有任何新 frame → 中止串流，交給 client 決定是否重連
             logger.warning("[MJPEG] timeout: robot_id=%s, camera_id=%s", robot_id, camera_id)
             break
 
-        item = frames.get(key)
-        if item is None:
-            # Jetson 還沒開始上傳或暫停中
-            await asyncio.sleep(0.1)
-            continue
-
-        frame: bytes = item["frame"]
-        ts: float = item.get("timestamp", 0.0)
-
-        # 若沒有「新」 frame，就稍微睡一下再看（不送任何東西，避免閃爍）
-        if ts == last_frame_ts:
-            await asyncio.sleep(0.01)
-            continue
+        last_send_time = time.time()
 
-        # 有新 frame 了，更新「最後有效時間」與 last_frame_ts
-        last_frame_ts = ts
-        last_valid_time = now
+        # 送出「這一幀最新」的影像（header 固定部分預先建好，一次 join）
+        yield b"".join((MJPEG_PREFIX, str(len(frame)).encode(), MJPEG_SUFFIX, frame, b"\r\n"))
 
-        # 控制對外串流 FPS：距離上次送出時間太短就等一下
-        elapsed = now - last_send_time
+        # 控制對外串流 FPS：送完後補足間隔，期間的舊 frame 直接略過，只會送最新的
+        elapsed = time.time() - last_send_time
         if elapsed < min_interval:
             await asyncio.sleep(min_interval - elapsed)
-            # 等完後再 loop 一次，此時 frames 可能又更新了，只會送最新的
-            continue
-
-        last_send_time = time.time()
-
-        # 建立 multipart header
-        header = (
-            f"--{MJPEG_BOUNDARY}\r\n"
-            "Content-Type: image/jpeg\r\n"
-            f"Content-Length: {len(frame)}\r\n"
-            "\r\n"
-        ).encode("utf-8")
-
-        # 送出「這一幀最新」的影像
-        yield header + frame + b"\r\n"
 
 
 @router.get("/mjpeg")
@@ -164,13 +198,13 @@ async def camera_snapshot(
       通常會比自己處理 MJPEG 還穩，不容易閃爍。
     """
     key = (robot_id, camera_id)
-    item = frames.get(key)
+    slot = frames.get(key)
 
-    if item is None:
+    # viewer 可能先建立了空的 slot，還沒有任何 frame 也視為 404
+    if slot is None or slot.frame is None:
         raise HTTPException(status_code=404, detail="No frame available for this robot/camera yet")
 
-    frame: bytes = item["frame"]
-    return Response(content=frame, media_type="image/jpeg")
+    return Response(content=slot.frame, media_type="image/jpeg")
 
 
 @router.get("/robots/online")
@@ -188,8 +222,8 @@ async def robots_online(threshold_seconds: int = 10):
     now = time.time()
     online: List[Dict[str, Any]] = []
 
-    for (robot_id, camera_id), info in frames.items():
-        ts = info.get("timestamp", 0)
+    for (robot_id, camera_id), slot in list(frames.items()):
+        ts = slot.timestamp
         if now - ts <= threshold_seconds:
             online.append(
                 {
@@ -199,4 +233,5 @@ async def robots_online(threshold_seconds: int = 10):
                 }
             )
 
-    return JSONResponse(content=online)
+    # 直接回 list，交給 FastAPI 預設的 JSONResponse 序列化
+    return online
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, HTTPException
 from typing import List
-import numpy as np
+import heapq
 from datetime import datetime, timezone, timedelta
 import zoneinfo
 
@@ -13,37 +13,38 @@ from models import (
 )
 
 # === Milvus 與 Embedding ===
-from milvus_helper import collection  # 已在 import 時 ensure_collection()
-from embedding_model import get_embedding
+from milvus_helper import (  # 已在 import 時 ensure_collection()
+    CHAT_COLLECTION_NAME, CHAT_SEARCH_PARAMS, chat_insert_batcher, collection, get_async_client, mark_dirty,
+    _ms_to_dt_utc, _ms_to_iso, _next_id, _now_ms,
+)
+from embedding_model import aget_embedding
 
 router = APIRouter()
 
 # 回傳欄位（集中管理）
 # 注意：這僅影響查詢輸出欄位，與 insert 的 schema 順序無關
-OUTPUT_FIELDS = [
+# 預設不拉 image_base64（單筆最大 64KB），request 帶 include_images=True 才拉
+LIST_OUTPUT_FIELDS = [
     "chatid", "robotid",
     "user_msg", "tool_msg", "ai_msg",
-    "image_base64", "createdtime",
-    "text",
+    "createdtime",
 ]
+FULL_OUTPUT_FIELDS = LIST_OUTPUT_FIELDS + ["image_base64"]
 
-# --------- 小工具：正規化與安全處理 ---------
 
+def _output_fields(include_images: bool) -> list:
+    return FULL_OUTPUT_FIELDS if include_images else LIST_OUTPUT_FIELDS
+
+# Milvus 篩選條件模板（集中管理；與 routers/kb.py 相同，值一律走 filter_params / expr_params 帶入，
+# 需 Milvus server 與 pymilvus >= 2.5）
+EXPR_BY_ROBOT       = "robotid == {robotid}"
+EXPR_BY_ROBOT_SINCE = "robotid == {robotid} && createdtime >= {cutoff_ms}"
+EXPR_BY_CHATID      = "chatid == {chatid}"
+EXPR_BY_CHATIDS     = "chatid in {chatids}"
+
+# --------- 小工具：正規化與安全處理 ---------
 
 
-def _parse_iso_to_dt_utc(ts: str) -> datetime:
-    """
-    把 createdtime (ISO8601, UTC) 字串轉成 datetime(aware, UTC)
-    若壞字串就丟掉那筆
-    """
-    try:
-        dt = datetime.fromisoformat(ts)
-        # 保險：如果沒有 tzinfo，就當成 UTC
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        return dt.astimezone(timezone.utc)
-    except Exception:
-        return None
 
 def _dt_utc_to_taipei_date_str(dt_utc: datetime) -> str:
     """
@@ -52,37 +53,23 @@ def _dt_utc_to_taipei_date_str(dt_utc: datetime) -> str:
     dt_local = dt_utc.astimezone(_TZ_TAIPEI)
     return dt_local.strftime("%Y-%m-%d")
 
-def _iso_days_ago_utc(days: int) -> str:
+def _ms_days_ago_utc(days: int) -> int:
     """
-    取得現在往回 days 天的 UTC ISO8601 字串，用於 Milvus 篩 createdtime。
-    例如 days=7 -> 現在-7天 的 UTC ISO 字串
+    取得現在往回 days 天的 UTC epoch 毫秒，用於 Milvus 篩 createdtime。
+    例如 days=7 -> 現在-7天 的毫秒時間戳
     """
     cutoff = datetime.now(timezone.utc) - timedelta(days=days)
-    return cutoff.isoformat()
-
+    return int(cutoff.timestamp() * 1000)
 
-def _now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat()
-
-def _gen_chatid() -> int:
-    # 使用毫秒級時間戳產 PK（簡單、可讀、幾乎不撞）
-    return int(datetime.now(timezone.utc).timestamp() * 1000)
 
 def _safe_str(v) -> str:
     # Milvus 的 string 欄位不接受 None
     return "" if v is None else str(v)
 
-def _safe_robotid(robotid: str) -> str:
-    # Milvus expr 中的字串要 escape 單引號
-    return (robotid or "").replace("'", "''")
-
-def _norm_vec(vec):
-    # 確保 float32 list，避免 dtype 或 numpy array 直接丟入導致不相容
-    return np.asarray(vec, dtype=np.float32).tolist()
-
 # --------- 轉換工具 ---------
 def _hit_to_chatmessage(hit) -> ChatMessage:
-    ent = hit.entity
+    # AsyncMilvusClient 的 hit 是 dict：{"id", "distance", "entity": {...}}
+    ent = hit["entity"]
     return ChatMessage(
         chatid=int(ent.get("chatid")),
         robotid=ent.get("robotid"),
@@ -90,7 +77,7 @@ def _hit_to_chatmessage(hit) -> ChatMessage:
         tool_msg=ent.get("tool_msg"),
         ai_msg=ent.get("ai_msg"),
         image_base64=ent.get("image_base64"),
-        createdtime=ent.get("createdtime"),
+        createdtime=_ms_to_iso(ent.get("createdtime")),
     )
 
 def _row_to_chatmessage(row: dict) -> ChatMessage:
@@ -101,28 +88,31 @@ def _row_to_chatmessage(row: dict) -> ChatMessage:
         tool_msg=row.get("tool_msg"),
         ai_msg=row.get("ai_msg"),
         image_base64=row.get("image_base64"),
-        createdtime=row.get("createdtime"),
+        createdtime=_ms_to_iso(row.get("createdtime")),
     )
 
 # --------- 路由 ---------
 @router.post("/search-chat", response_model=GetChatHistoryResponse)
-def search_chat(data: SearchChatRequest):
+async def search_chat(data: SearchChatRequest):
     """
     以語義搜尋相似對話（僅用 Milvus）：
       - 先把 query_text 轉 embedding
       - 以 robotid 過濾，再依相似度排序回傳
+    embedding 與 Milvus search 都以 await 等待，不會卡住 event loop。
     """
-    query_vec = _norm_vec(get_embedding(data.query_text))
-    safe_robot = _safe_robotid(data.robotid)
+    # aget_embedding 已回傳 float32 list，可直接丟給 Milvus
+    query_vec = await aget_embedding(data.query_text)
 
     try:
-        results = collection.search(
+        results = await get_async_client().search(
+            collection_name=CHAT_COLLECTION_NAME,
             data=[query_vec],
             anns_field="embedding",
-            param={"metric_type": "L2", "params": {"nprobe": 10}},  # 與索引設定一致
+            search_params=CHAT_SEARCH_PARAMS,  # 與索引設定一致（見 milvus_helper）
             limit=data.limit or 5,
-            expr=f"robotid == '{safe_robot}'",
-            output_fields=OUTPUT_FIELDS
+            filter=EXPR_BY_ROBOT,
+            filter_params={"robotid": data.robotid},
+            output_fields=_output_fields(data.include_images)
         )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Milvus search failed: {e}")
@@ -134,53 +124,66 @@ def search_chat(data: SearchChatRequest):
     return GetChatHistoryResponse(message="語意查詢成功", history=history)
 
 @router.post("/get-chat-history", response_model=GetChatHistoryResponse)
-def get_chat_history(data: GetChatHistoryRequest):
+async def get_chat_history(data: GetChatHistoryRequest):
     """
     取某 robotid 歷史對話：
-      - 從 Milvus 把該 robotid 的資料全部拉回來（上限 16384）
-      - 依 createdtime 由新到舊排序
+      - 第一段：只拉 chatid + createdtime（INT64，走 scalar index），找出最新 limit 筆
+      - 第二段：用 chatid in [...] 只把這 limit 筆的完整欄位拉回來
       - 回傳「新 -> 舊」
     """
     limit = getattr(data, "limit", None) or 20
-    safe_robot = _safe_robotid(data.robotid)
+    client = get_async_client()
 
     try:
-        raw = collection.query(
-            expr=f"robotid == '{safe_robot}'",
-            output_fields=OUTPUT_FIELDS,
-            # Milvus query offset+limit 上限 16384，這裡直接全吃
+        keys = await client.query(
+            collection_name=CHAT_COLLECTION_NAME,
+            filter=EXPR_BY_ROBOT,
+            filter_params={"robotid": data.robotid},
+            output_fields=["chatid", "createdtime"],
+            # Milvus query offset+limit 上限 16384；只拿兩個整數欄位，量很小
             limit=16384,
         )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Milvus query failed: {e}")
 
-    if not raw:
+    if not keys:
         return GetChatHistoryResponse(message="沒有資料", history=[])
 
-    # createdtime 由新到舊
-    raw.sort(key=lambda r: r.get("createdtime") or "", reverse=True)
+    # createdtime 由新到舊，只拿前 limit 筆（nlargest 為 O(N log limit)，不必整個排序）
+    picked = heapq.nlargest(limit, keys, key=lambda r: r.get("createdtime") or 0)
+    picked_ids = [int(r["chatid"]) for r in picked]
 
-    # 只拿前 limit 筆
-    picked = raw[:limit]
+    try:
+        rows = await client.query(
+            collection_name=CHAT_COLLECTION_NAME,
+            filter=EXPR_BY_CHATIDS,
+            filter_params={"chatids": picked_ids},
+            output_fields=_output_fields(data.include_images),
+            limit=len(picked_ids),
+        )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Milvus query failed: {e}")
 
-    # 這裡不要再 reverse() 了，維持「新 -> 舊」
-    history = [_row_to_chatmessage(r) for r in picked]
+    # 第二段回來的順序不保證，依第一段的排序重排，維持「新 -> 舊」
+    by_id = {int(r["chatid"]): r for r in rows}
+    history = [_row_to_chatmessage(by_id[i]) for i in picked_ids if i in by_id]
     return GetChatHistoryResponse(message="取得聊天紀錄成功", history=history)
 
 
 @router.post("/add-chat", response_model=AddChatResponse)
-def add_chat(data: AddChatRequest):
+async def add_chat(data: AddChatRequest):
     """
     寫入一輪對話（Milvus only）：
-      - chatid: 毫秒級時間戳
-      - createdtime: ISO8601 (UTC)
+      - chatid: 毫秒級時間戳（同一毫秒內遞增，不重複）
+      - createdtime: UTC epoch 毫秒（INT64）
       - text: user/tool/ai 三段合併，供語義檢索
     """
     if not data.robotid:
         raise HTTPException(status_code=400, detail="robotid 不可為空")
 
-    chatid = _gen_chatid()
-    created = _now_iso()
+    # chatid 走 _next_id：同一毫秒進來的多筆 request 不會拿到相同 PK
+    created = _now_ms()
+    chatid = _next_id()
 
     # 組語義文本（全部轉字串且容忍 None）
     text = " ".join([
@@ -189,7 +192,7 @@ def add_chat(data: AddChatRequest):
         _safe_str(data.ai_msg),
     ]).strip()
 
-    embedding = _norm_vec(get_embedding(text))
+    embedding = await aget_embedding(text)
 
     # --- 關鍵修正：所有 string 欄位都保證不是 None ---
     user_msg = _safe_str(data.user_msg)
@@ -200,18 +203,18 @@ def add_chat(data: AddChatRequest):
     try:
         # 插入順序需與 collection schema 完全一致（請確認你的建表順序）
         # 假設 schema 順序：chatid, robotid, embedding, text, user_msg, tool_msg, ai_msg, image_base64, createdtime
-        collection.insert([
-            [chatid],           # chatid
-            [data.robotid],     # robotid
-            [embedding],        # embedding
-            [text],             # text
-            [user_msg],         # user_msg
-            [tool_msg],         # tool_msg
-            [ai_msg],           # ai_msg
-            [img_b64],          # image_base64
-            [created],          # createdtime
+        # 交給 batcher 與其他 request 合併成一次 insert RPC，寫入完成才返回
+        await chat_insert_batcher.ainsert([
+            chatid,             # chatid
+            data.robotid,       # robotid
+            embedding,          # embedding
+            text,               # text
+            user_msg,           # user_msg
+            tool_msg,           # tool_msg
+            ai_msg,             # ai_msg
+            img_b64,            # image_base64
+            created,            # createdtime
         ])
-        # 視需求：collection.flush()
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Milvus insert failed: {e}")
 
@@ -222,9 +225,10 @@ def delete_chat(chatid: int):
     """
     刪除指定 chatid（Milvus）
     """
-    expr = f"chatid == {chatid}"
+    params = {"chatid": chatid}
     try:
-        mr = collection.delete(expr=expr)
+        mr = collection.delete(expr=EXPR_BY_CHATID, expr_params=params)
+        mark_dirty(CHAT_COLLECTION_NAME)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Milvus delete failed: {e}")
 
@@ -234,7 +238,7 @@ def delete_chat(chatid: int):
             raise HTTPException(status_code=404, detail="找不到該 chatid")
     except Exception:
         try:
-            remains = collection.query(expr=expr, output_fields=["chatid"], limit=1)
+            remains = collection.query(expr=EXPR_BY_CHATID, expr_params=params, output_fields=["chatid"], limit=1)
             if remains:
                 raise HTTPException(status_code=500, detail="刪除未生效，請稍後再試")
         except Exception as e:
@@ -243,37 +247,33 @@ def delete_chat(chatid: int):
     return AddChatResponse(message=f"已刪除 chatid={chatid}")
 
 @router.post("/chat-stats-7d", response_model=ChatStats7dResponse)
-def chat_stats_7d(data: ChatStats7dRequest):
+async def chat_stats_7d(data: ChatStats7dRequest):
     """
     回傳這個 robot 在最近 7 天內的每日對話次數 (依台北當地日期分組)。
 
     作法：
-    1. 算出 UTC 現在往回 7 天的 ISO 時間字串 cutoff_iso
+    1. 算出 UTC 現在往回 7 天的毫秒時間戳 cutoff_ms
     2. 用 Milvus query:
          - robotid == 'xxx'
-         - createdtime >= cutoff_iso   (因為是 ISO8601 UTC，字典序 ≈ 時間序)
+         - createdtime >= cutoff_ms   (INT64 整數比較，可走 STL_SORT 索引)
     3. 取回 rows 後：
-         - 把每筆 createdtime parse 成 UTC datetime
+         - 把每筆 createdtime 轉成 UTC datetime
          - 轉台北時間，取當地日期字串 'YYYY-MM-DD'
          - 做 counter
     4. 確保完全覆蓋「今天往前 6 天」，即共 7 天
          - 沒資料的日子 count = 0 也要回
     """
 
-    safe_robot = _safe_robotid(data.robotid)
-
     # 7 天前 (含今天共 7 天): 我們先抓「現在-7天」當 cutoff
-    # 例如今天 2025-10-29，cutoff 就是 2025-10-22T...Z
-    cutoff_iso = _iso_days_ago_utc(7)
-
-    expr = (
-        f"robotid == '{safe_robot}' && createdtime >= '{cutoff_iso}'"
-    )
+    # 例如今天 2025-10-29，cutoff 就是 2025-10-22T... 的毫秒時間戳
+    cutoff_ms = _ms_days_ago_utc(7)
 
     try:
         # 把近 7 天內的資料全部拉回來，量通常不會爆到幾十萬
-        raw = collection.query(
-            expr=expr,
+        raw = await get_async_client().query(
+            collection_name=CHAT_COLLECTION_NAME,
+            filter=EXPR_BY_ROBOT_SINCE,
+            filter_params={"robotid": data.robotid, "cutoff_ms": cutoff_ms},
             output_fields=["createdtime"],
             limit=10000  # 防呆上限，可調
         )
@@ -286,7 +286,7 @@ def chat_stats_7d(data: ChatStats7dRequest):
 
     for r in raw:
         ts = r.get("createdtime")
-        dt_utc = _parse_iso_to_dt_utc(ts)
+        dt_utc = _ms_to_dt_utc(ts)
         if dt_utc is None:
             continue
         d_local = _dt_utc_to_taipei_date_str(dt_utc)
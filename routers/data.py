@@ -1,6 +1,8 @@
-from fastapi import APIRouter, HTTPException
-from psycopg2.extras import RealDictCursor
-from db import get_connection
+import time
+
+import asyncpg
+from fastapi import APIRouter, Depends, HTTPException, Request
+from db import get_conn
 from models import (
     BaseRobotIdRequest,
     GetUserNicknameResponse,
@@ -10,77 +12,118 @@ from models import (
     UpdateNameRequest,
     UpdatePromptStyleRequest,
     RobotListResponse,
-    BaseUserIdRequest
+    BaseUserIdRequest,
+    RobotItem,
+    VoiceItem,
 )
-from security import is_input_safe_for_sql, validate_uuid
+from security import validate_uuid
 
 router = APIRouter()
 
+# ------------------------
+# SQL（集中管理）
+# asyncpg 依 SQL 文字在每條連線上快取 prepared statement（見 db.PG_STATEMENT_CACHE_SIZE），
+# 同一段文字第二次起只送 Bind/Execute，不再重新 parse/plan；因此同一查詢一律共用這裡的常數
+# ------------------------
+_ROBOT_CONFIG_COLUMNS = """
+    SELECT
+        r.robotid,
+        r.userid,
+        r.voiceid,
+        v.voicename,
+        r.promptstyle,
+        r.robotname,
+        r.status,
+        r.updatedtime
+    FROM robot r
+    LEFT JOIN voice v ON v.voiceid = r.voiceid
+"""
+SQL_ROBOT_CONFIG     = _ROBOT_CONFIG_COLUMNS + "WHERE r.robotid = $1"
+SQL_ROBOTS_BY_USERID = _ROBOT_CONFIG_COLUMNS + "WHERE r.userid = $1 ORDER BY r.updatedtime DESC"
+SQL_USER_NICKNAME    = "SELECT ua.nickname FROM useraccount ua WHERE ua.userid = $1"
+SQL_VOICE_LIST       = "SELECT voiceid, voicename, description FROM voice ORDER BY voiceid"
+
+# 單欄位更新：UPDATE ... RETURNING 包在 CTE 裡直接 join voice，一次 round-trip 拿回更新後的完整配置
+# 沒有任何一列被更新（robotid 不存在）時不回傳任何列
+_UPDATE_RETURNING_CONFIG = """
+    WITH u AS (
+        UPDATE robot SET {column} = $1, updatedtime = NOW()
+        WHERE robotid = $2
+        RETURNING robotid, userid, voiceid, promptstyle, robotname, status, updatedtime
+    )
+    SELECT
+        u.robotid,
+        u.userid,
+        u.voiceid,
+        v.voicename,
+        u.promptstyle,
+        u.robotname,
+        u.status,
+        u.updatedtime
+    FROM u
+    LEFT JOIN voice v ON v.voiceid = u.voiceid
+"""
+SQL_SET_NAME        = _UPDATE_RETURNING_CONFIG.format(column="robotname")
+SQL_SET_PROMPTSTYLE = _UPDATE_RETURNING_CONFIG.format(column="promptstyle")
+
+# 換聲音時把 voice 存在檢查併進同一句：固定回一列，voice_exists 區分「voiceid 不存在」與「robotid 不存在」
+SQL_SET_VOICE = """
+    WITH u AS (
+        UPDATE robot SET voiceid = $1, updatedtime = NOW()
+        WHERE robotid = $2 AND EXISTS (SELECT 1 FROM voice WHERE voiceid = $1)
+        RETURNING robotid, userid, voiceid, promptstyle, robotname, status, updatedtime
+    )
+    SELECT
+        EXISTS (SELECT 1 FROM voice WHERE voiceid = $1) AS voice_exists,
+        u.robotid,
+        u.userid,
+        u.voiceid,
+        v.voicename,
+        u.promptstyle,
+        u.robotname,
+        u.status,
+        u.updatedtime
+    FROM (SELECT 1) AS one
+    LEFT JOIN u ON TRUE
+    LEFT JOIN voice v ON v.voiceid = u.voiceid
+"""
+
+
+# voice 表幾乎不變：整份清單在記憶體快取 VOICE_CACHE_TTL 秒，命中時連 pool 連線都不借
+VOICE_CACHE_TTL = 60
+_voice_cache: list | None = None
+_voice_cache_at = 0.0
+
 
 # ------------------------
 # 共用檢查/查詢函式
 # ------------------------
+# 合法 UUID 只含 hex / '-'，不可能命中任何 SQL/XSS/路徑模式，
+# 通過 validate_uuid 就不必再跑 is_input_safe_for_sql 那組 regex
 def _check_robotid(robotid: str):
-    """檢查 robotid 格式與安全性"""
+    """檢查 robotid 格式（UUID 白名單即足以保證安全）"""
     if not validate_uuid(robotid):
         raise HTTPException(status_code=400, detail="robotid 格式不合法")
-    safe, reasons = is_input_safe_for_sql(robotid)
-    if not safe:
-        raise HTTPException(status_code=400, detail=f"robotid 包含非法輸入: {reasons}")
 
 
-def _fetch_robot_config(cursor, robotid: str) -> dict | None:
-    """讀取單一機器人的完整配置（含 voice join）"""
-    cursor.execute(
-        """
-        SELECT
-            r.robotid,
-            r.userid,
-            r.voiceid,
-            v.voicename,
-            r.promptstyle,
-            r.robotname,
-            r.status,
-            r.updatedtime
-        FROM robot r
-        LEFT JOIN voice v ON v.voiceid = r.voiceid
-        WHERE r.robotid = %s
-        """,
-        (robotid,),
-    )
-    return cursor.fetchone()
+def _check_userid(userid: str):
+    """檢查 userid 格式（UUID 白名單即足以保證安全）"""
+    if not validate_uuid(userid):
+        raise HTTPException(status_code=400, detail="userid 格式不合法")
 
 
-def _ensure_voice_exists(cursor, voiceid: int):
-    """若 DB 未設外鍵，建議在應用層先驗證 voice 是否存在"""
-    cursor.execute("SELECT 1 FROM voice WHERE voiceid = %s", (voiceid,))
-    if cursor.fetchone() is None:
-        raise HTTPException(status_code=400, detail="voiceid 不存在")
+async def _fetch_robot_config(conn: asyncpg.Connection, robotid: str) -> asyncpg.Record | None:
+    """讀取單一機器人的完整配置（含 voice join）"""
+    return await conn.fetchrow(SQL_ROBOT_CONFIG, robotid)
 
 
 # ------------------------
 # 查詢類 API
 # ------------------------
 @router.post("/get-user-nickname", response_model=GetUserNicknameResponse)
-def get_user_nickname(data: BaseUserIdRequest):
-    if not validate_uuid(data.userid):
-        raise HTTPException(status_code=400, detail="userid 格式不合法")
-    safe, reasons = is_input_safe_for_sql(data.userid)
-    if not safe:
-        raise HTTPException(status_code=400, detail=f"userid 包含非法輸入: {reasons}")
-    conn = get_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        """
-        SELECT ua.nickname
-        FROM useraccount ua
-        WHERE ua.userid = %s
-        """,
-        (data.userid,),
-    )
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
+async def get_user_nickname(data: BaseUserIdRequest, conn: asyncpg.Connection = Depends(get_conn)):
+    _check_userid(data.userid)
+    result = await conn.fetchrow(SQL_USER_NICKNAME, data.userid)
 
     if not result:
         raise HTTPException(status_code=404, detail="找不到對應的使用者")
@@ -89,230 +132,100 @@ def get_user_nickname(data: BaseUserIdRequest):
 
 
 @router.post("/get-robot-config", response_model=RobotConfigResponse)
-def get_robot_config(data: BaseRobotIdRequest):
+async def get_robot_config(data: BaseRobotIdRequest, conn: asyncpg.Connection = Depends(get_conn)):
     _check_robotid(data.robotid)
 
-    conn = get_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        """
-        SELECT
-            r.robotid,
-            r.userid,
-            r.voiceid,
-            v.voicename,
-            r.promptstyle,
-            r.robotname,
-            r.status,
-            r.updatedtime
-        FROM robot r
-        LEFT JOIN voice v ON v.voiceid = r.voiceid
-        WHERE r.robotid = %s
-        """,
-        (data.robotid,),
-    )
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    result = await _fetch_robot_config(conn, data.robotid)
 
     if not result:
         raise HTTPException(status_code=404, detail="找不到對應的機器人配置")
 
-    result["message"] = "查詢成功"
-    return result
+    # Record 可直接 ** 展開成 response model，不必先複製成 dict 再補 message
+    return RobotConfigResponse(message="查詢成功", **result)
 
 
 @router.post("/get-robots-by-userid", response_model=RobotListResponse)
-def get_robots_by_userid(data: BaseUserIdRequest):
-    if not validate_uuid(data.userid):
-        raise HTTPException(status_code=400, detail="userid 格式不合法")
-    safe, reasons = is_input_safe_for_sql(data.userid)
-    if not safe:
-        raise HTTPException(status_code=400, detail=f"userid 包含非法輸入: {reasons}")
+async def get_robots_by_userid(data: BaseUserIdRequest, conn: asyncpg.Connection = Depends(get_conn)):
+    _check_userid(data.userid)
 
-    conn = None
-    cursor = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(
-            """
-            SELECT
-                r.robotid,
-                r.userid,
-                r.voiceid,
-                v.voicename,
-                r.promptstyle,
-                r.robotname,
-                r.status,
-                r.updatedtime
-            FROM robot r
-            LEFT JOIN voice v ON v.voiceid = r.voiceid
-            WHERE r.userid = %s
-            ORDER BY r.updatedtime DESC
-            """,
-            (data.userid,),
-        )
-        rows = cursor.fetchall() or []
-        return {"message": "查詢成功", "robots": rows}
+        rows = await conn.fetch(SQL_ROBOTS_BY_USERID, data.userid)
+        return RobotListResponse(message="查詢成功", robots=[RobotItem(**r) for r in rows])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查詢失敗: {e}")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 
 @router.get("/get-voice-list", response_model=VoiceListResponse)
-def get_voice_list():
+async def get_voice_list(request: Request):
     """
-    取得 voice 表的完整清單。
+    取得 voice 表的完整清單（TTL 快取，見 VOICE_CACHE_TTL）。
     回傳欄位：voiceid, voicename, description
     """
-    conn = None
-    cursor = None
+    global _voice_cache, _voice_cache_at
     try:
-        conn = get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(
-            """
-            SELECT voiceid, voicename, description
-            FROM voice
-            ORDER BY voiceid
-            """
-        )
-        rows = cursor.fetchall() or []
-        return VoiceListResponse(message="查詢成功", voices=rows)
+        if _voice_cache is None or time.monotonic() - _voice_cache_at > VOICE_CACHE_TTL:
+            async with request.app.state.pg.acquire() as conn:
+                rows = await conn.fetch(SQL_VOICE_LIST)
+            _voice_cache = [VoiceItem(**r) for r in rows]
+            _voice_cache_at = time.monotonic()
+        return VoiceListResponse(message="查詢成功", voices=_voice_cache)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查詢失敗: {e}")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 
 # ------------------------
 # 單欄位更新 API（分開）
 # ------------------------
 @router.patch("/set-robot-voice", response_model=RobotConfigResponse)
-def set_robot_voice(data: UpdateVoiceRequest):
+async def set_robot_voice(data: UpdateVoiceRequest, conn: asyncpg.Connection = Depends(get_conn)):
     _check_robotid(data.robotid)
 
-    conn = None
-    cursor = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        _ensure_voice_exists(cursor, data.voiceid)
-
-        cursor.execute(
-            """
-            UPDATE robot
-            SET voiceid = %s, updatedtime = NOW()
-            WHERE robotid = %s
-            """,
-            (data.voiceid, data.robotid),
-        )
-        if cursor.rowcount == 0:
+        row = await conn.fetchrow(SQL_SET_VOICE, data.voiceid, data.robotid)
+        # 若 DB 未設外鍵，應用層仍要擋掉不存在的 voiceid
+        if not row["voice_exists"]:
+            raise HTTPException(status_code=400, detail="voiceid 不存在")
+        if row["robotid"] is None:
             raise HTTPException(status_code=404, detail="找不到對應的機器人")
 
-        conn.commit()
-
-        result = _fetch_robot_config(cursor, data.robotid)
-        if not result:
-            raise HTTPException(status_code=404, detail="找不到對應的機器人配置")
-        result["message"] = "更新成功"
-        return result
+        # voice_exists 不在 model 欄位內，建構時會被忽略
+        return RobotConfigResponse(message="更新成功", **row)
 
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新失敗: {e}")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 
 @router.patch("/set-robot-name", response_model=RobotConfigResponse)
-def set_robot_name(data: UpdateNameRequest):
+async def set_robot_name(data: UpdateNameRequest, conn: asyncpg.Connection = Depends(get_conn)):
     _check_robotid(data.robotid)
 
-    conn = None
-    cursor = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        cursor.execute(
-            """
-            UPDATE robot
-            SET robotname = %s, updatedtime = NOW()
-            WHERE robotid = %s
-            """,
-            (data.robotname, data.robotid),
-        )
-        if cursor.rowcount == 0:
+        row = await conn.fetchrow(SQL_SET_NAME, data.robotname, data.robotid)
+        if row is None:
             raise HTTPException(status_code=404, detail="找不到對應的機器人")
 
-        conn.commit()
-
-        result = _fetch_robot_config(cursor, data.robotid)
-        if not result:
-            raise HTTPException(status_code=404, detail="找不到對應的機器人配置")
-        result["message"] = "更新成功"
-        return result
+        return RobotConfigResponse(message="更新成功", **row)
 
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新失敗: {e}")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 
 @router.patch("/set-robot-promptstyle", response_model=RobotConfigResponse)
-def set_robot_promptstyle(data: UpdatePromptStyleRequest):
+async def set_robot_promptstyle(data: UpdatePromptStyleRequest, conn: asyncpg.Connection = Depends(get_conn)):
     _check_robotid(data.robotid)
 
-    conn = None
-    cursor = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        cursor.execute(
-            """
-            UPDATE robot
-            SET promptstyle = %s, updatedtime = NOW()
-            WHERE robotid = %s
-            """,
-            (data.promptstyle, data.robotid),
-        )
-        if cursor.rowcount == 0:
+        row = await conn.fetchrow(SQL_SET_PROMPTSTYLE, data.promptstyle, data.robotid)
+        if row is None:
             raise HTTPException(status_code=404, detail="找不到對應的機器人")
 
-        conn.commit()
-
-        result = _fetch_robot_config(cursor, data.robotid)
-        if not result:
-            raise HTTPException(status_code=404, detail="找不到對應的機器人配置")
-        result["message"] = "更新成功"
-        return result
+        return RobotConfigResponse(message="更新成功", **row)
 
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新失敗: {e}")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
@@ -1,47 +1,51 @@
 from fastapi import APIRouter, HTTPException, Query
-from datetime import datetime, timezone
 from typing import List
-import numpy as np
+import heapq
+from operator import itemgetter
 
 from models import (
     AddKnowledgeRequest, AddKnowledgeResponse, BaseResponse,
     SearchKnowledgeRequest, SearchKnowledgeResponse, KnowledgeChunk,
     GetKnowledgeListRequest, GetKnowledgeListResponse
 )
-from milvus_helper import kb_collection
-from embedding_model import get_embedding
+from milvus_helper import (  # 已在 import 時 ensure_collection()
+    KB_COLLECTION_NAME, KB_MAX_LENGTHS, KB_SEARCH_PARAMS, get_async_client, kb_collection, kb_insert_batcher, mark_dirty,
+    _ms_to_iso, _next_id, _now_ms,
+)
+from embedding_model import aget_embedding
 
 router = APIRouter()
 
 # 需要回傳的欄位（與 kb schema 對齊）
 KB_OUTPUT_FIELDS = ["docid", "robotid", "text", "title", "source", "createdtime"]
 
-# --------- 小工具 ---------
-def _now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat()
-
-def _gen_docid() -> int:
-    return int(datetime.now(timezone.utc).timestamp() * 1000)
+# Milvus 篩選條件模板：值一律走 expr_params / filter_params 帶入（pymilvus >= 2.5），
+# 不在 Python 端跳脫、拼字串；模板固定，Milvus 端可重用解析結果
+EXPR_BY_ROBOT       = "robotid == {robotid}"
+EXPR_BY_DOC_ROBOT   = "docid == {docid} && robotid == {robotid}"
+EXPR_BY_DOCIDS      = "docid in {docids}"
 
+# --------- 小工具 ---------
 def _safe_str(v) -> str:
     return "" if v is None else str(v)
 
-def _safe_robotid(robotid: str) -> str:
-    return (robotid or "").replace("'", "''")
-
-def _norm_vec(vec):
-    return np.asarray(vec, dtype=np.float32).tolist()
+def _check_lengths(**fields):
+    # 超長欄位在進 batcher 前就擋下：不必算 embedding，也不會讓同批 insert 失敗
+    for name, value in fields.items():
+        if len(value.encode("utf-8")) > KB_MAX_LENGTHS[name]:
+            raise HTTPException(status_code=400, detail=f"{name} 超過 {KB_MAX_LENGTHS[name]} bytes 上限")
 
 # --------- 轉換工具 ---------
 def _hit_to_chunk(hit) -> KnowledgeChunk:
-    ent = hit.entity
+    # AsyncMilvusClient 的 hit 是 dict：{"id", "distance", "entity": {...}}
+    ent = hit["entity"]
     return KnowledgeChunk(
         docid=int(ent.get("docid")),
         robotid=ent.get("robotid"),
         text=ent.get("text"),
         title=ent.get("title"),
         source=ent.get("source"),
-        createdtime=ent.get("createdtime"),
+        createdtime=_ms_to_iso(ent.get("createdtime")),
     )
 
 def _row_to_chunk(row: dict) -> KnowledgeChunk:
@@ -51,37 +55,40 @@ def _row_to_chunk(row: dict) -> KnowledgeChunk:
         text=row.get("text"),
         title=row.get("title"),
         source=row.get("source"),
-        createdtime=row.get("createdtime"),
+        createdtime=_ms_to_iso(row.get("createdtime")),
     )
 
 # --------- 路由 ---------
 @router.post("/add-knowledge", response_model=AddKnowledgeResponse)
-def add_knowledge(data: AddKnowledgeRequest):
+async def add_knowledge(data: AddKnowledgeRequest):
     if not data.robotid:
         raise HTTPException(status_code=400, detail="robotid 不可為空")
     if not data.text or not data.text.strip():
         raise HTTPException(status_code=400, detail="text 不可為空")
 
-    docid = _gen_docid()
-    created = _now_iso()
-    embedding = _norm_vec(get_embedding(data.text))
-
     title = _safe_str(data.title)
     source = _safe_str(data.source)
+    _check_lengths(robotid=data.robotid, text=data.text, title=title, source=source)
+
+    # docid 走 _next_id：同一毫秒進來的多筆 request 不會拿到相同 PK
+    created = _now_ms()
+    docid = _next_id()
+    # 由 embedding_model 的背景 worker 與其他 request 合併成一批 encode，await 時不佔 threadpool
+    embedding = await aget_embedding(data.text)
 
     try:
         # 插入順序需與 kb_collection schema 完全一致：
         # docid, robotid, embedding, text, title, source, createdtime
-        kb_collection.insert([
-            [docid],
-            [data.robotid],
-            [embedding],
-            [data.text],
-            [title],
-            [source],
-            [created],
+        # 交給 batcher 與其他 request 合併成一次 insert RPC（寫入後由 batcher mark_dirty），寫入完成才返回
+        await kb_insert_batcher.ainsert([
+            docid,
+            data.robotid,
+            embedding,
+            data.text,
+            title,
+            source,
+            created,
         ])
-        # 視需求：kb_collection.flush()
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Milvus insert failed: {e}")
 
@@ -89,55 +96,45 @@ def add_knowledge(data: AddKnowledgeRequest):
 
 @router.delete("/delete-knowledge/{docid}", response_model=BaseResponse)
 def delete_knowledge(docid: int, robotid: str = Query(..., description="為避免刪到他人的資料，必須帶上 robotid")):
-    safe_robot = _safe_robotid(robotid)
-
+    """
+    刪除指定 docid（必須屬於該 robotid）：只打一次 delete，
+    由回傳的 delete_count 判斷是否存在，不再先查、後驗。
+    """
     try:
-        exists = kb_collection.query(
-            expr=f"docid == {docid} && robotid == '{safe_robot}'",
-            output_fields=["docid"],
-            limit=1
+        mr = kb_collection.delete(
+            expr=EXPR_BY_DOC_ROBOT,
+            expr_params={"docid": docid, "robotid": robotid},
         )
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Milvus query failed: {e}")
-
-    if not exists:
-        raise HTTPException(status_code=404, detail="找不到此 docid 或不屬於該 robotid")
-
-    try:
-        kb_collection.delete(expr=f"docid == {docid} && robotid == '{safe_robot}'")
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Milvus delete failed: {e}")
 
-    try:
-        remains = kb_collection.query(
-            expr=f"docid == {docid} && robotid == '{safe_robot}'",
-            output_fields=["docid"], limit=1
-        )
-        if remains:
-            raise HTTPException(status_code=500, detail="刪除未生效，請稍後再試")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Milvus query failed after delete: {e}")
+    if mr.delete_count == 0:
+        raise HTTPException(status_code=404, detail="找不到此 docid 或不屬於該 robotid")
 
+    mark_dirty(KB_COLLECTION_NAME)
     return BaseResponse(message=f"已刪除 docid={docid}")
 
 @router.post("/search-knowledge", response_model=SearchKnowledgeResponse)
-def search_knowledge(data: SearchKnowledgeRequest):
+async def search_knowledge(data: SearchKnowledgeRequest):
     """
     語意搜尋（與對話搜尋一致的邏輯）：
     - 用 query_text 取 embedding
     - 以 robotid 過濾
     - 依相似度排序回傳
+    embedding 與 Milvus search 都以 await 等待，不會卡住 event loop。
     """
-    query_vec = _norm_vec(get_embedding(data.query_text))
-    safe_robot = _safe_robotid(data.robotid)
+    # aget_embedding 已回傳 float32 list，可直接丟給 Milvus
+    query_vec = await aget_embedding(data.query_text)
 
     try:
-        results = kb_collection.search(
+        results = await get_async_client().search(
+            collection_name=KB_COLLECTION_NAME,
             data=[query_vec],
             anns_field="embedding",
-            param={"metric_type": "L2", "params": {"nprobe": 10}},
+            search_params=KB_SEARCH_PARAMS,
             limit=data.limit or 5,
-            expr=f"robotid == '{safe_robot}'",
+            filter=EXPR_BY_ROBOT,
+            filter_params={"robotid": data.robotid},
             output_fields=KB_OUTPUT_FIELDS
         )
     except Exception as e:
@@ -150,28 +147,46 @@ def search_knowledge(data: SearchKnowledgeRequest):
     return SearchKnowledgeResponse(message="語意查詢成功", items=items)
 
 @router.post("/get-knowledge", response_model=GetKnowledgeListResponse)
-def get_knowledge(data: GetKnowledgeListRequest):
+async def get_knowledge(data: GetKnowledgeListRequest):
     """
-    拉取某 robotid 的知識清單（最新 N 筆），新 -> 舊
+    拉取某 robotid 的知識清單（最新 N 筆），新 -> 舊：
+      - 第一段：只拉 docid，找出最新 limit 筆（不必把最多 16384 筆的 text 整包拉回）
+      - 第二段：用 docid in [...] 只把這 limit 筆的完整欄位拉回來
     """
     limit = getattr(data, "limit", None) or 20
-    safe_robot = _safe_robotid(data.robotid)
+    client = get_async_client()
 
     try:
-        raw = kb_collection.query(
-            expr=f"robotid == '{safe_robot}'",
-            output_fields=KB_OUTPUT_FIELDS,
+        keys = await client.query(
+            collection_name=KB_COLLECTION_NAME,
+            filter=EXPR_BY_ROBOT,
+            filter_params={"robotid": data.robotid},
+            output_fields=["docid"],
+            # Milvus query offset+limit 上限 16384；只拿一個整數欄位，量很小
             limit=16384,
         )
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Milvus query failed: {e}")
 
-    if not raw:
+    if not keys:
         return GetKnowledgeListResponse(message="沒有資料", items=[])
 
-    # 新 -> 舊
-    raw.sort(key=lambda r: r.get("createdtime") or "", reverse=True)
-    picked = raw[:limit]
+    # docid 以寫入時的毫秒時間戳為基準、單調遞增（見 _next_id）：直接比整數（itemgetter 走 C）就是「新 -> 舊」
+    picked = heapq.nlargest(limit, keys, key=itemgetter("docid"))
+    picked_ids = [int(r["docid"]) for r in picked]
+
+    try:
+        rows = await client.query(
+            collection_name=KB_COLLECTION_NAME,
+            filter=EXPR_BY_DOCIDS,
+            filter_params={"docids": picked_ids},
+            output_fields=KB_OUTPUT_FIELDS,
+            limit=len(picked_ids),
+        )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Milvus query failed: {e}")
 
-    items = [_row_to_chunk(r) for r in picked]
+    # 第二段回來的順序不保證，依第一段的排序重排，維持「新 -> 舊」
+    by_id = {int(r["docid"]): r for r in rows}
+    items = [_row_to_chunk(by_id[i]) for i in picked_ids if i in by_id]
     return GetKnowledgeListResponse(message="取得知識清單成功", items=items)
@@ -7,7 +7,6 @@ import re
 import html
 import json
 from typing import Optional, Tuple, List
-from uuid import UUID
 
 # ---------- 模式定義（移除 inline (?i)，在 compile 時統一指定 IGNORECASE） ----------
 _SQL_INJECTION_PATTERNS = [
@@ -49,6 +48,15 @@ _XSS_RE = re.compile("|".join(f"(?:{p})" for p in _XSS_PATTERNS),
                     re.IGNORECASE | re.DOTALL)
 _PATH_RE = re.compile("|".join(f"(?:{p})" for p in _PATH_TRAVERSAL_PATTERNS),
                       re.IGNORECASE)
+# 三類合併成一條：乾淨輸入（絕大多數）只掃一次，有命中才逐類找原因
+# （SQL 模式排最前面，內含的 \1 群組編號才與 _SQL_RE 相同；路徑模式沒有 .，DOTALL 不影響）
+_ANY_GUARD_RE = re.compile(
+    "|".join(f"(?:{p})" for p in _SQL_INJECTION_PATTERNS + _XSS_PATTERNS + _PATH_TRAVERSAL_PATTERNS),
+    re.IGNORECASE | re.DOTALL,
+)
+
+# UUID 驗證：只接受標準 8-4-4-4-12 十六進位格式（版本不限）
+_UUID_RE = re.compile(r"\A[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\Z")
 
 # 檔名驗證（允許英數、底線、破折號、點、空格，長度上限 255）
 _FILENAME_RE = re.compile(r"^[\w\-. ]{1,255}$", re.UNICODE)
@@ -89,14 +97,8 @@ def is_path_traversal(s: str) -> bool:
 
 # ---------- 型別化驗證（白名單優先） ----------
 def validate_uuid(s: str) -> bool:
-    """驗證是否為合法 UUID 字串（版本不限）。"""
-    if not isinstance(s, str) or not s:
-        return False
-    try:
-        UUID(s)
-        return True
-    except Exception:
-        return False
+    """驗證是否為合法 UUID 字串（版本不限，需為 8-4-4-4-12 標準格式）。"""
+    return isinstance(s, str) and _UUID_RE.match(s) is not None
 
 
 def validate_int(s: str, min_val: Optional[int] = None, max_val: Optional[int] = None) -> bool:
@@ -158,6 +160,9 @@ def is_input_safe_for_sql(s: str, *, allow_unicode: bool = True) -> Tuple[bool,
     if contains_control_chars(s):
         reasons.append("contains control characters")
 
+    if not _ANY_GUARD_RE.search(s):
+        return (len(reasons) == 0), reasons
+
     inj, pat = is_probably_sql_injection(s)
     if inj:
         # 注意：為了避免回傳過長的原始匹配內容，這裡只回傳前 200 字節
@@ -1,9 +1,13 @@
 import logging
+import queue
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 
 from uvicorn.logging import AccessFormatter, DefaultFormatter
 
 from fastapi import FastAPI
+from db import close_sync_pool, create_pool
 from routers import auth, data, chat, kb, camera
 
 # Set up logging with timestamps and file output
@@ -23,9 +27,14 @@ stream_handler.setFormatter(console_formatter)
 file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
 file_handler.setFormatter(file_formatter)
 
+# 寫檔交給背景 thread：request 端只把 record 丟進 queue，不在 logging 鎖底下等磁碟 I/O
+log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+log_listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+log_listener.start()
+
 logging.basicConfig(
     level=logging.INFO,
-    handlers=[stream_handler, file_handler],
+    handlers=[stream_handler, QueueHandler(log_queue)],
 )
 
 # 讓 uvicorn logger 帶時間戳並保留彩色輸出
@@ -51,7 +60,21 @@ for logger_name in ("uvicorn.access",):
 logger = logging.getLogger(__name__)
 logger.info("Logging initialized; writing to %s", LOG_FILE)
 
-app = FastAPI(title="Kirox API", version="1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # asyncpg 連線池：啟動時建立，關閉時釋放（routers/data.py 透過 db.get_conn 取用）
+    app.state.pg = await create_pool()
+    logger.info("PostgreSQL pool ready")
+    try:
+        yield
+    finally:
+        await app.state.pg.close()
+        close_sync_pool()
+        log_listener.stop()  # 把 queue 裡剩下的 log 寫完再結束
+
+# 不設 default_response_class：有 response_model 的路由由 FastAPI 直接用 Pydantic dump_json 序列化，
+# 換成 ORJSONResponse 反而會關掉這條路（新版 FastAPI 也已標為 deprecated）
+app = FastAPI(title="Kirox API", version="1.0", lifespan=lifespan)
 
 API_PREFIX = "/api/v1"  # 想改成 /api 或 /v2 都行
 
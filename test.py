@@ -2,6 +2,8 @@ from sentence_transformers import SentenceTransformer
 model = SentenceTransformer("BAAI/bge-small-zh-v1.5")
 print(model)
 print(model.get_sentence_embedding_dimension())  
-vec = model.encode(["hello world"])[0]
+# 與 embedding_model.embedding_worker 相同的呼叫方式：直接輸出已 L2 normalize 的 numpy
+vec = model.encode(["hello world"], convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)[0]
 print(len(vec))   
+print("L2 norm（IP 即 cosine，應為 1）：", float((vec ** 2).sum() ** 0.5))
 print("模型裝置：", model.device)